@@ -13,8 +13,9 @@ Frames per Second over time.
 """
 
 import argparse
+import concurrent.futures
 import csv
-import subprocess
+import functools
 import sys
 import os.path as path
 import numpy as np
@@ -23,6 +24,19 @@ import tempfile
 from collections import namedtuple as namedtuple
 from enum import Enum as Enum
 
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    # Optional: enables the binary Parquet mirror of parsed logs.
+    pyarrow = None
+
+try:
+    import pandas as pd
+except ImportError:
+    # Optional: speeds up CSV parsing via pandas' C tokenizer.
+    pd = None
+
 
 class FrameTimeResult(object):
     '''
@@ -33,106 +47,227 @@ class FrameTimeResult(object):
     MillisPerSecond = 10**3
     TargetFPS = 45
     TargetFrameTime = NanosPerSecond / TargetFPS
+    CacheSuffix = '.cache.npz'
 
     def __init__(self):
         self.path = ""
         self.run_name = ""
-        self.raw_frametimes = []
-        self.frame_states = []
+        self.raw_frametimes = np.empty(0, dtype=np.int64)
+        self.sorted_frametimes = np.empty(0, dtype=np.int64)
+        self.frame_states = np.empty(0, dtype=np.int8)
         self.total_duration_ms = -1
         self.average_frametime_ms = -1
-        self.percentile_frametime_ms = []
+        self._median_ms = None
+        self._p90_ms = None
+        self._p95_ms = None
+        self._percent_missed = None
+        self._percentile_frametime_ms = None
         self.state_to_duration_ms = {}
 
     @staticmethod
-    def from_file(log_path, gameplay_state=None, gameplay_duration=None, drop_first_seconds=None):
+    def make_cache_key(full_path, gameplay_state, gameplay_duration, drop_first_seconds):
+        """
+        Returns an array identifying the log file contents and filtering options.
+        A cached result is valid only if its stored key matches the current one.
+        """
+        def to_num(value):
+            return -1 if value is None else value
+
+        return np.array([path.getmtime(full_path), path.getsize(full_path),
+                         to_num(gameplay_state), to_num(gameplay_duration),
+                         to_num(drop_first_seconds)], dtype=np.float64)
+
+    @staticmethod
+    def from_cache(cache_path, cache_key):
+        """
+        Reconstructs a FrameTimeResult from a cache file.
+        Returns None if the cache is missing or was created with a different
+        log file version or different filtering options.
+        """
+        if not path.exists(cache_path):
+            return None
+
+        cached = np.load(cache_path)
+        if not np.array_equal(cached['key'], cache_key):
+            return None
+
+        result = FrameTimeResult()
+        result.path = str(cached['path'])
+        result.run_name = str(cached['run_name'])
+        result.raw_frametimes = cached['raw_frametimes']
+        result.sorted_frametimes = cached['sorted_frametimes']
+        result.frame_states = cached['frame_states']
+        result.total_duration_ms = float(cached['total_duration_ms'])
+        result.average_frametime_ms = float(cached['average_frametime_ms'])
+        result.state_to_duration_ms = \
+            {int(s): float(ms) for s, ms in zip(cached['states'], cached['state_durations_ms'])}
+        return result
+
+    def save_cache(self, cache_path, cache_key):
+        """Saves all parsed and derived data to a cache file next to the log."""
+        states = np.array(sorted(self.state_to_duration_ms.keys()), dtype=np.int64)
+        state_durations_ms = np.array([self.state_to_duration_ms[int(s)] for s in states])
+        np.savez(cache_path, key=cache_key, path=self.path, run_name=self.run_name,
+                 raw_frametimes=self.raw_frametimes,
+                 sorted_frametimes=self.sorted_frametimes,
+                 frame_states=self.frame_states,
+                 total_duration_ms=self.total_duration_ms,
+                 average_frametime_ms=self.average_frametime_ms,
+                 states=states, state_durations_ms=state_durations_ms)
+
+    @staticmethod
+    def load_log(full_path, use_cache):
+        """
+        Loads the raw (frame time, state) columns from a log file.
+        With |use_cache| set and pyarrow available, the parsed columns are
+        mirrored into a Parquet file next to the log; repeat reads stream the
+        binary columns directly and skip the ASCII tokenizer altogether.
+        """
+        parquet_path = full_path + '.parquet'
+        if use_cache and pyarrow is not None and path.exists(parquet_path) and \
+                path.getmtime(parquet_path) >= path.getmtime(full_path):
+            table = pyarrow.parquet.read_table(parquet_path)
+            return np.column_stack((table.column('frametime_nanos').to_numpy(),
+                                    table.column('frame_state').to_numpy()))
+
+        if pd is not None:
+            # The pandas C tokenizer parses large logs several times faster
+            # than np.loadtxt's row-at-a-time reader.
+            log_data = pd.read_csv(full_path, dtype=np.int64, engine='c',
+                                   usecols=(0, 1)).to_numpy()
+        else:
+            log_data = np.loadtxt(full_path, dtype=np.int64, delimiter=',',
+                                  skiprows=1, usecols=(0, 1), ndmin=2)
+        if use_cache and pyarrow is not None:
+            pyarrow.parquet.write_table(
+                pyarrow.table({'frametime_nanos': log_data[:, 0],
+                               'frame_state': log_data[:, 1]}),
+                parquet_path, compression='zstd')
+        return log_data
+
+    @staticmethod
+    def from_file(log_path, gameplay_state=None, gameplay_duration=None, drop_first_seconds=None,
+                  use_cache=True):
         """
         Creates a FrameTimeResult from a file.
         - if |gameplay_state| is specified, all frame time statistics will include frames only in that state;
         - if |gameplay_duration| is specified, all frame times after the specified duration (in seconds) will be discarded;
-        - if |drop_first_seconds| is specified, the specified number of initial benchmark seconds will be discarded.
+        - if |drop_first_seconds| is specified, the specified number of initial benchmark seconds will be discarded;
+        - if |use_cache| is set, results are cached next to the log file and re-runs
+          over an unchanged log with the same options skip parsing entirely.
         """
         full_path = path.realpath(log_path)
         base = path.basename(full_path)
         parent_dir = path.basename(path.dirname(full_path))
 
+        cache_path = full_path + FrameTimeResult.CacheSuffix
+        cache_key = FrameTimeResult.make_cache_key(full_path, gameplay_state,
+                                                   gameplay_duration, drop_first_seconds)
+        if use_cache:
+            cached_result = FrameTimeResult.from_cache(cache_path, cache_key)
+            if cached_result is not None:
+                return cached_result
+
         result = FrameTimeResult()
         result.path = full_path
         result.run_name = parent_dir + '/' + base
-        seen_states = set()
 
-        with open(full_path) as csvfile:
-            log_file = csv.reader(csvfile)
-            for i, row in enumerate(log_file):
-                if i == 0:
-                    continue
-                assert len(row) == 2
+        log_data = FrameTimeResult.load_log(full_path, use_cache)
+        frametimes = log_data[:, 0]
+        # States are small non-negative integers; int8 keeps the per-frame
+        # footprint at one byte instead of eight.
+        frame_states = log_data[:, 1].astype(np.int8)
 
-                frametime_nanos = int(row[0])
-                frame_state = int(row[1])
-                seen_states.add(frame_state)
-                if frame_state not in result.state_to_duration_ms:
-                    result.state_to_duration_ms[frame_state] = 0
+        # One weighted bincount accumulates the time spent in every state.
+        state_counts = np.bincount(frame_states)
+        state_durations_ms = np.bincount(frame_states, weights=frametimes) / result.NonosPerMilli
+        result.state_to_duration_ms = \
+            {int(s): float(state_durations_ms[s]) for s in np.flatnonzero(state_counts)}
 
-                result.state_to_duration_ms[frame_state] += frametime_nanos / result.NonosPerMilli
-                if gameplay_state is not None and gameplay_state != frame_state:
-                    continue
+        if gameplay_state is not None:
+            in_gameplay_state = frame_states == gameplay_state
+            frametimes = frametimes[in_gameplay_state]
+            frame_states = frame_states[in_gameplay_state]
 
-                result.raw_frametimes.append(frametime_nanos)
-                result.frame_states.append(frame_state)
+        result.raw_frametimes = frametimes
+        result.frame_states = frame_states
 
         if drop_first_seconds is not None:
             drop_first_nanos = drop_first_seconds * result.NanosPerSecond
-            curr_duration = 0
-            drop_end = 0
-            for frametime in result.raw_frametimes:
-                curr_duration += frametime
-                if curr_duration >= drop_first_nanos:
-                    break
-
-                drop_end += 1
-
+            # Index of the first frame whose cumulative duration reaches the cutoff.
+            drop_end = int(np.searchsorted(np.cumsum(result.raw_frametimes), drop_first_nanos))
             result.raw_frametimes = result.raw_frametimes[drop_end:]
             result.frame_states = result.frame_states[drop_end:]
 
         if gameplay_duration is not None:
             target_duration_nanos = gameplay_duration * result.NanosPerSecond
-            curr_duration = 0
-            first_frame_to_discard = 0
-            for frametime in result.raw_frametimes:
-                curr_duration += frametime
-                first_frame_to_discard += 1
-                if curr_duration > target_duration_nanos:
-                    break
-
+            # Keep frames up to and including the first one that crosses the target duration.
+            cumulative_duration = np.cumsum(result.raw_frametimes)
+            first_frame_to_discard = min(
+                int(np.searchsorted(cumulative_duration, target_duration_nanos, side='right')) + 1,
+                cumulative_duration.size)
             result.raw_frametimes = result.raw_frametimes[:first_frame_to_discard]
             result.frame_states = result.frame_states[:first_frame_to_discard]
 
-        result.total_duration_ms = np.sum(result.raw_frametimes) / result.NonosPerMilli
-        result.average_frametime_ms = np.average(result.raw_frametimes) / result.NonosPerMilli
-        result.percentile_frametime_ms = \
-            [np.percentile(result.raw_frametimes, p) / result.NonosPerMilli for p in range(100)]
+        # One reduction over the array serves both the total and the average.
+        total_duration_nanos = int(np.sum(result.raw_frametimes))
+        result.total_duration_ms = total_duration_nanos / result.NonosPerMilli
+        result.average_frametime_ms = \
+            total_duration_nanos / result.raw_frametimes.size / result.NonosPerMilli
+        # Sort once; all percentile queries are answered by indexing this array.
+        result.sorted_frametimes = np.sort(result.raw_frametimes)
+
+        if use_cache:
+            result.save_cache(cache_path, cache_key)
 
         return result
 
+    def percentiles_ms(self, percentiles):
+        '''
+        Returns the requested frame time percentiles (in [0, 100]) in milliseconds,
+        gathered from the sorted frame time array with linear interpolation
+        (matching np.percentile).
+        '''
+        positions = np.asarray(percentiles) / 100 * (self.sorted_frametimes.size - 1)
+        lower = positions.astype(np.int64)
+        upper = np.minimum(lower + 1, self.sorted_frametimes.size - 1)
+        lower_values = self.sorted_frametimes[lower]
+        interpolated = lower_values + (positions - lower) * (self.sorted_frametimes[upper] - lower_values)
+        return interpolated / self.NonosPerMilli
+
+    @property
+    def percentile_frametime_ms(self):
+        '''The full 0th-99th percentile table, computed only when asked for.'''
+        if self._percentile_frametime_ms is None:
+            self._percentile_frametime_ms = self.percentiles_ms(np.arange(100))
+        return self._percentile_frametime_ms
+
     def p50(self):
-        assert len(self.percentile_frametime_ms) == 100
-        return self.percentile_frametime_ms[50]
+        return float(self.percentiles_ms(50))
 
     def p90(self):
-        assert len(self.percentile_frametime_ms) == 100
-        return self.percentile_frametime_ms[90]
+        if self._p90_ms is None:
+            self._p90_ms = float(self.percentiles_ms(90))
+        return self._p90_ms
 
     def p95(self):
-        assert len(self.percentile_frametime_ms) == 100
-        return self.percentile_frametime_ms[95]
+        if self._p95_ms is None:
+            self._p95_ms = float(self.percentiles_ms(95))
+        return self._p95_ms
 
     def median(self):
-        return self.p50()
+        # Memoized: sorting results by median queries this O(K log K) times.
+        if self._median_ms is None:
+            self._median_ms = self.p50()
+        return self._median_ms
 
     def percent_missed(self):
         '''Returns the percent of frames that lasted more than the target frametime'''
-        return np.average([1 if x > self.TargetFrameTime else 0 for x in self.raw_frametimes]) * 100
+        if self._percent_missed is None:
+            num_missed = self.sorted_frametimes.size - \
+                np.searchsorted(self.sorted_frametimes, self.TargetFrameTime, side='right')
+            self._percent_missed = num_missed / self.sorted_frametimes.size * 100
+        return self._percent_missed
 
     def time_in_state(self, state_idx):
         '''
@@ -144,20 +279,24 @@ class FrameTimeResult(object):
         return 0
 
     def fps_over_time(self):
+        '''
+        Returns a pair of equal-length per-second arrays: the number of frames
+        presented within each second and the frame state in that second.
+        '''
         duration_s = int(self.total_duration_ms / 1000) + 1
-        bins = [(0, 0)] * duration_s
-        curr_duration_ns = 0
 
         assert len(self.raw_frametimes) == len(self.frame_states)
-        for frame_time, frame_state in zip(self.raw_frametimes, self.frame_states):
-            curr_duration_ns += frame_time
-            bin_idx = int(curr_duration_ns / self.NanosPerSecond)
-            # Arbitrarily decide to keep the latest frame state in the current bin.
-            # Instead, we could also get the longest state within this state, first one,
-            # or decide some other way.
-            bins[bin_idx] = (bins[bin_idx][0] + 1, frame_state)
-
-        return bins
+        bin_idx = np.cumsum(self.raw_frametimes) // self.NanosPerSecond
+        counts = np.bincount(bin_idx, minlength=duration_s)
+        # Arbitrarily decide to keep the latest frame state in the current bin.
+        # Instead, we could also get the longest state within this state, first one,
+        # or decide some other way. The last frame of each occupied bin is found
+        # by detecting the boundaries where the bin index changes.
+        bin_states = np.zeros(duration_s, dtype=np.int8)
+        last_in_bin = np.flatnonzero(np.diff(bin_idx, append=bin_idx[-1] + 1))
+        bin_states[bin_idx[last_in_bin]] = self.frame_states[last_in_bin]
+
+        return counts, bin_states
 
     def dump(self):
         print(f'{self.run_name}:\tduration: {self.total_duration_ms:.3f} ms,\taverage: {self.average_frametime_ms:.3f} ms')
@@ -187,31 +326,56 @@ def data_low(data):
 def data_high(data):
     return np.percentile(data, 95)
 
+def percentile_of_sorted(sorted_data, percentile):
+    '''
+    Returns the given percentile of an already-sorted array with linear
+    interpolation (matching np.percentile), without re-sorting.
+    '''
+    position = percentile / 100 * (sorted_data.size - 1)
+    lower = int(position)
+    upper = min(lower + 1, sorted_data.size - 1)
+    return sorted_data[lower] + (position - lower) * (sorted_data[upper] - sorted_data[lower])
+
 def summarize_frame_times(results, summary_fns):
+    """
+    Summarizes per-result metrics with each of |summary_fns|.
+    Returns the metric-to-summaries mapping together with the results sorted
+    by median so that callers do not have to re-sort.
+    """
     sorted_results = sorted(results, key=lambda x: x.median())
-    medians = [x.median() for x in sorted_results]
-    low_median = data_low(medians)
-    high_median = data_high(medians)
-    considered_results = list(filter(lambda x: low_median < x.median() < high_median, sorted_results))
+    # The results are sorted by median, so the median column is sorted too and
+    # its p5/p95 can be indexed directly instead of re-sorting in np.percentile.
+    medians = np.fromiter((x.median() for x in sorted_results), dtype=np.float64,
+                          count=len(sorted_results))
+    low_median = percentile_of_sorted(medians, 5)
+    high_median = percentile_of_sorted(medians, 95)
+    considered_mask = (medians > low_median) & (medians < high_median)
+    considered_results = [sorted_results[i] for i in np.flatnonzero(considered_mask)]
     if len(considered_results) == 0:
         considered_results = sorted_results
 
+    # Extract each per-result metric column once; every summary function
+    # reduces the same ndarrays instead of rebuilding per-call lists.
+    num_results = len(results)
+    metric_to_values = {
+        'avg': np.fromiter((x.average_frametime_ms for x in results), dtype=np.float64, count=num_results),
+        'median': np.fromiter((x.median() for x in results), dtype=np.float64, count=num_results),
+        'p90': np.fromiter((x.p90() for x in results), dtype=np.float64, count=num_results),
+        'p95': np.fromiter((x.p95() for x in results), dtype=np.float64, count=num_results),
+        'missed_percent': np.fromiter((x.percent_missed() for x in results), dtype=np.float64, count=num_results),
+        'init_time': np.fromiter((x.time_in_state(0) for x in results), dtype=np.float64, count=num_results),
+    }
+
     metric_to_summaries = {}
     for summary_fn in summary_fns:
-        avg = summary_fn.fn([x.average_frametime_ms for x in results])
-        median = summary_fn.fn([x.median() for x in results])
-        p90 = summary_fn.fn([x.p90() for x in results])
-        p95 = summary_fn.fn([x.p95() for x in results])
-        missed_percent = summary_fn.fn([x.percent_missed() for x in results])
-        init_time = summary_fn.fn([x.time_in_state(0) for x in results])
-
-        metrics = FrameTimesMetrics(avg, median, p90, p95, missed_percent, init_time)
+        metrics = FrameTimesMetrics._make(
+            summary_fn.fn(metric_to_values[name]) for name in FrameTimesMetrics._fields)
         for metric_value, metric_name in zip(metrics, metrics._fields):
             if metric_name not in metric_to_summaries:
                 metric_to_summaries[metric_name] = []
             metric_to_summaries[metric_name].append((summary_fn, metric_value))
 
-    return metric_to_summaries
+    return metric_to_summaries, sorted_results
 
 def relative_noise(data):
     min_res = data_low(data)
@@ -226,6 +390,7 @@ def main():
     parser.add_argument('--drop_front', type=int, default=None, help='Number of seconds of the initial data to ignore')
     parser.add_argument('--gameplay_state', type=int, default=None, help='The only state number to consider when calculating frame times statistics')
     parser.add_argument('--print_csv', type=bool, default=False, help='Prints stats as comma separated values (CSV)')
+    parser.add_argument('--no_cache', type=bool, default=False, help='Disables caching of parsed logs next to the log files')
     parser.add_argument('-v', '--verbose', type=bool, default=False, help='Output gif file name')
     args = parser.parse_args()
 
@@ -234,6 +399,7 @@ def main():
     drop_front = args.drop_front
     gameplay_state = args.gameplay_state
     use_csv = args.print_csv
+    use_cache = not args.no_cache
     verbose = args.verbose
 
     separator = ',' if use_csv else '\t\t'
@@ -241,11 +407,20 @@ def main():
     for dataset in datasets:
         dataset_name = dataset[0]
         print(f'~~~~ Processing dataset {dataset_name} ~~~~\n')
-        results = []
-        for file in dataset[1:]:
-            results.append(FrameTimeResult.from_file(file, gameplay_state, gameplay_duration, drop_front))
-            if verbose:
-                results[-1].dump()
+        log_files = dataset[1:]
+        parse_fn = functools.partial(FrameTimeResult.from_file, gameplay_state=gameplay_state,
+                                     gameplay_duration=gameplay_duration,
+                                     drop_first_seconds=drop_front, use_cache=use_cache)
+        if len(log_files) < 2:
+            results = [parse_fn(file) for file in log_files]
+        else:
+            # Each log is parsed independently; spread the files across all CPUs.
+            with concurrent.futures.ProcessPoolExecutor() as executor:
+                results = list(executor.map(parse_fn, log_files))
+
+        if verbose:
+            for result in results:
+                result.dump()
                 print()
 
         print(f'Dataset: {dataset_name}{separator}size: {len(results)}')
@@ -261,14 +436,14 @@ def main():
             results_header = results_header + separator + summary_fn.name
         print(results_header)
 
-        for metric, summaries in summarize_frame_times(results, summary_fns).items():
+        metric_to_summaries, sorted_results = summarize_frame_times(results, summary_fns)
+        for metric, summaries in metric_to_summaries.items():
             summarized_metric_str = metric
             for summary_fn, metric_value in summaries:
                 summarized_metric_str = summarized_metric_str + separator + format_summarized_value(summary_fn, metric_value)
             print(summarized_metric_str)
 
         print()
-        sorted_results = sorted(results, key=lambda x: x.median())
         median_res = sorted_results[len(sorted_results) // 2]
         print(f'Median result for {dataset_name}:')
         median_res.dump()
@@ -277,17 +452,20 @@ def main():
         low_p5_idx = int(len(sorted_results) * 0.05)
         high_p95_idx = int(len(sorted_results) * 0.95)
 
-        p5_fps_over_time = sorted_results[low_p5_idx].fps_over_time()
-        median_fps_over_time = median_res.fps_over_time()
-        p95_fps_over_time = sorted_results[high_p95_idx].fps_over_time()
-        with open(dataset_name + '_fps.csv', 'w') as fps_file:
-            fps_csv = csv.writer(fps_file)
-            fps_csv.writerow(('Second', 'Low FPS', 'Low State',
-                              'Median FPS', 'Median State',
-                              'High FPS', 'High State'))
-            for i, (x, y, z) in enumerate(zip(p5_fps_over_time, median_fps_over_time, p95_fps_over_time)):
-                fps_csv.writerow((i, x[0], x[1], y[0], y[1], z[0], z[1]))
-            print('Fps saved as: ' + dataset_name + '_fps.csv')
+        p5_counts, p5_states = sorted_results[low_p5_idx].fps_over_time()
+        median_counts, median_states = median_res.fps_over_time()
+        p95_counts, p95_states = sorted_results[high_p95_idx].fps_over_time()
+        num_seconds = min(len(p5_counts), len(median_counts), len(p95_counts))
+        fps_table = np.column_stack((np.arange(num_seconds),
+                                     p5_counts[:num_seconds], p5_states[:num_seconds],
+                                     median_counts[:num_seconds], median_states[:num_seconds],
+                                     p95_counts[:num_seconds], p95_states[:num_seconds]))
+        header = ','.join(('Second', 'Low FPS', 'Low State',
+                           'Median FPS', 'Median State',
+                           'High FPS', 'High State'))
+        np.savetxt(dataset_name + '_fps.csv', fps_table, fmt='%d', delimiter=',',
+                   header=header, comments='')
+        print('Fps saved as: ' + dataset_name + '_fps.csv')
         print('---------------------------------------------------------------------\n')
 
 if __name__ == '__main__':
@@ -27,7 +27,6 @@ To see full command line options documentation, run:
   plot_timeline.py --help
 """
 
-import re
 import pandas as pd
 import sys
 import numpy as np
@@ -37,76 +36,41 @@ import csv
 import matplotlib
 matplotlib.use('Agg')  # Allows to work without X dispaly
 
+from collections import namedtuple
+
 nanos_per_second = 10**9
 nanos_per_milli = 10**6
 
 
-class FrameEvent:
-    """
-    A datastructure containing Frame event data
-
-    A frame event starts with `frame_present` and contains frame_time
-    and the frame state information.
-    """
-
-    def __init__(self, timestamp: int, event_str: str):
-        self.timestamp = timestamp
-
-        pattern = r',frame_time:(\d+),started:([0-1])'
-        attributes = re.match(pattern, event_str)
-        assert (attributes)
-        attributes = attributes.groups()
-        assert (len(attributes) >= 2)
+# Frame events start with `frame_present` and carry the frame state
+# information. All columns are equal-length arrays: one entry per event,
+# timestamps in nanoseconds since the start of the log.
+FrameEvents = namedtuple('FrameEvents', ['timestamps', 'started'])
 
-        self.frame_time = int(attributes[0])
-        self.started = int(attributes[1])
+# Pipeline events start with `create_graphics_pipelines` or
+# `create_compute_pipelines` and carry the shader hashes and pipeline creation
+# duration. |hashes| is a list of tuples; the other columns are arrays.
+PipelineEvents = namedtuple('PipelineEvents', ['timestamps', 'hashes', 'durations'])
 
 
-class PipelineEvent:
+def get_frames_per_second(frame_events):
     """
-    A datastructure containing Pipline event data.
-
-    A Pipeline event starts with `create_graphics_pipelines` or
-    `create_compute_pipelines` and contains the shader hashes and pipline duration.
+    Buckets |frame_events| (a FrameEvents column set) by seconds. Returns 3
+    equal-length arrays, (xs, ys, states). For each second xs[i], ys[i]
+    represents frames elapsed in that second, and states[i] state in that
+    second.
     """
+    timestamps = frame_events.timestamps
+    num_events = len(timestamps)
 
-    def __init__(self, timestamp: int, event_str: str):
-        self.timestamp = timestamp
-
-        pattern = r',hashes:"\[((0x[a-f0-9]*)+,*)+\]",duration:(\d+)'
-        attributes = re.match(pattern, event_str)
-        assert (attributes)
-        attributes = attributes.groups()
-        assert (len(attributes) >= 2)
-
-        self.hashes = attributes[:-1]
-        self.duration = int(attributes[-1])
+    # Sliding one-second window over the sorted timestamps: the number of
+    # events in (t - 1s, t] is the distance between each event and the first
+    # event still inside its window (equivalent to rolling('1s').count()).
+    window_start = np.searchsorted(timestamps, timestamps - nanos_per_second, side='right')
+    ys = (np.arange(1, num_events + 1) - window_start).astype(np.float64)
 
-
-def get_frames_per_second(frame_present_events):
-    """
-    Buckets |frame_present_events| by seconds. Returns 3 equal-length arrays,
-    (xs, ys, states). For each second xs[i], ys[i] represents frames elapsed in
-    that second, and states[i] state in that second.
-    """
-    num_events = len(frame_present_events)
-    df = pd.DataFrame({'V': [e.started for e in frame_present_events]}, index=[
-                      pd.Timedelta(e.timestamp) for e in frame_present_events])
-    fps = list(df.rolling('1s').count()['V'])
-    assert len(fps) == num_events
-
-    xs = np.zeros(num_events)
-    ys = np.zeros(num_events)
-    states = np.zeros(num_events, dtype=np.int32)
-
-    for i, event in enumerate(frame_present_events):
-        timepoint, _frame_time, state = event.timestamp, event.frame_time, event.started
-        elapsed_seconds = timepoint / nanos_per_second
-        xs[i] = elapsed_seconds
-        ys[i] = fps[i]
-        states[i] = state
-
-    return xs, ys, states
+    xs = timestamps / nanos_per_second
+    return xs, ys, frame_events.started
 
 
 def split_by_state(xs, ys, states):
@@ -115,33 +79,26 @@ def split_by_state(xs, ys, states):
     divided by state. This is to plot multiple line segments with different color for
     each segment.
     """
-    res = []
-    last_state = None
-    for x, y, s in zip(xs, ys, states):
-        if s != last_state:
-            res.append((s, [], []))
-            last_state = s
-
-        res[-1][1].append(x)
-        res[-1][2].append(y)
+    if len(states) == 0:
+        return []
 
-    return res
+    # Run boundaries are the positions where the state changes; the segments
+    # between them are O(1) array views, not copies.
+    boundaries = np.flatnonzero(np.diff(states) != 0) + 1
+    starts = np.concatenate(([0], boundaries))
+    ends = np.concatenate((boundaries, [len(states)]))
+    return [(states[start], xs[start:end], ys[start:end])
+            for start, end in zip(starts, ends)]
 
 
-def get_pipeline_creation_times(create_pipeline_events):
+def get_pipeline_creation_times(pipeline_events):
     """
     Returns a pair of equal-length arrays that map times of pipeline creations
     (in seconds) to the time it took to create them (in milliseconds).
+    |pipeline_events| is a PipelineEvents column set.
     """
-    xs = []
-    ys = []
-
-    for event in create_pipeline_events:
-        elapsed_seconds = event.timestamp / nanos_per_second
-        xs.append(elapsed_seconds)
-        ys.append(event.duration / nanos_per_milli)
-
-    return xs, ys
+    return (pipeline_events.timestamps / nanos_per_second,
+            pipeline_events.durations / nanos_per_milli)
 
 
 def plot_frames_per_second(ax, events_by_type):
@@ -177,22 +134,65 @@ def plot_pipeline_creations(ax, events_by_type):
     return max_creation_time_millis
 
 
-def parse_event_log(log: str) -> (str, int, str):
+PipelineEventTypes = ('create_graphics_pipelines', 'create_compute_pipelines')
+
+
+def parse_event_log_file(eventlog_filename):
     """
-    Returns a triple containing event name, timestamp, and rest of event which
-    may be empty or contain attributes.
+    Parses a whole event log with pandas and groups the events by type.
     log format sample:
     sample1: `compile_time_layer_init,timestamp:123`
     sample2: `frame_present,timestamp:1667942408738000395,frame_time:9707270,started:1`
+
+    Returns a pair (events_by_type, duration_nanos). frame_present rows are
+    collected into a FrameEvents column set and pipeline creation rows into a
+    PipelineEvents column set. Rows of other types still count towards the log
+    duration but are not retained: the plots never read them. All timestamps
+    are rebased to the first event in the log.
     """
-    # This pattern captures `event_type`, `timestamp`, and the rest of the event.
-    pattern = r'(\w+),timestamp:(\d+)(.*)'
-    result = re.match(pattern, log).groups()
-    assert (len(result) >= 2)
-    event_type = result[0]
-    timestamp = int(result[1])
-    attributes = result[2]
-    return event_type, timestamp, attributes
+    with open(eventlog_filename) as input_file:
+        num_fields = max(line.count(',') for line in input_file) + 1
+
+    # One C-level parse of the whole log; rows have a variable number of
+    # fields, so pad the column names to the widest row and disable quote
+    # handling to keep the raw field text.
+    df = pd.read_csv(eventlog_filename, header=None, names=range(num_fields),
+                     engine='c', dtype=str, quoting=csv.QUOTE_NONE)
+
+    timestamps = df[1].str.slice(len('timestamp:')).astype(np.int64)
+    start_timestamp = timestamps.iloc[0]
+    rel_timestamps = (timestamps - start_timestamp).to_numpy()
+    duration_nanos = int(rel_timestamps.max())
+
+    event_types = df[0].to_numpy()
+    events_by_type = {}
+
+    frame_mask = event_types == 'frame_present'
+    if frame_mask.any():
+        # The frame_time field is not extracted: the plots derive everything
+        # from the timestamps and states.
+        started = df.loc[frame_mask, 3].str.slice(len('started:')).astype(np.int32).to_numpy()
+        events_by_type['frame_present'] = \
+            FrameEvents(rel_timestamps[frame_mask], started)
+
+    for pipeline_type in PipelineEventTypes:
+        pipeline_mask = event_types == pipeline_type
+        if not pipeline_mask.any():
+            continue
+
+        pipeline_rows = df.loc[pipeline_mask]
+        # The duration is the last populated field of each row; the hash list
+        # spans the fields in between because it contains commas itself.
+        durations = pipeline_rows.ffill(axis=1).iloc[:, -1] \
+            .str.slice(len('duration:')).astype(np.int64).to_numpy()
+        hashes = []
+        for _, row in pipeline_rows.iterrows():
+            hashes_str = ','.join(row.dropna().tolist()[2:-1])
+            hashes.append(tuple(hashes_str[hashes_str.find('[') + 1:hashes_str.find(']')].split(',')))
+        events_by_type[pipeline_type] = \
+            PipelineEvents(rel_timestamps[pipeline_mask], hashes, durations)
+
+    return events_by_type, duration_nanos
 
 
 def main():
@@ -218,26 +218,7 @@ def main():
     max_creation_time_millis = 0
 
     for dataset_idx, (dataset_name, eventlog_filename) in enumerate(args.dataset):
-        start_timestamp = None
-        duration_nanos = 0
-        events_by_type = {}
-
-        with open(eventlog_filename) as input_file:
-            for i, row in enumerate(input_file):
-                event_type, event_timestamp, event_attributes = parse_event_log(row)
-                if i == 0:
-                    start_timestamp = event_timestamp
-                if event_type not in events_by_type:
-                    events_by_type[event_type] = []
-
-                nanos_since_start = event_timestamp - start_timestamp
-                duration_nanos = max(nanos_since_start, duration_nanos)
-                if event_type == 'frame_present':
-                    events_by_type[event_type].append(FrameEvent(nanos_since_start, event_attributes))
-                elif event_type == 'create_graphics_pipelines' or event_type == 'create_compute_pipelines':
-                    events_by_type[event_type].append(PipelineEvent(nanos_since_start, event_attributes))
-                else:
-                    events_by_type[event_type].append((nanos_since_start,) + (event_attributes,))
+        events_by_type, duration_nanos = parse_event_log_file(eventlog_filename)
 
         duration_seconds = duration_nanos / nanos_per_second
         max_duration_seconds = max(max_duration_seconds, duration_seconds)